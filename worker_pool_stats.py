@@ -1,18 +1,30 @@
 #!/usr/bin/env python3
 
-from collections import defaultdict
-from csv import DictWriter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from functools import lru_cache
 import argparse
+import csv
 import json
 import logging
-import re
+import os
 import sys
 
 import taskcluster
 
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:  # orjson is optional, use the slower standard library
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
 logger = logging.getLogger(__name__)
 
+# Buffer size for output files, to coalesce many small writes
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+
 
 def main(
         auth_options,
@@ -21,7 +33,8 @@ def main(
         json_file=None,
         from_json_file=None,
         csv_file=None,
-        full_csv_datetimes=False
+        full_csv_datetimes=False,
+        resume_file=None,
     ):
     """
     Collect and summarize worker data for a pool
@@ -35,10 +48,12 @@ def main(
     full_csv_datetimes - If True, keep microseconds and timezones on dates.
       This may prevent them from being interpreted as dates by spreadsheet
       programs.
+    resume_file - Path to a file to record pagination progress, so an
+      interrupted run can resume where it stopped
     """
     if from_json_file:
-        with open(from_json_file, 'r') as the_file:
-            workers = json.load(the_file)
+        with open(from_json_file, 'rb') as the_file:
+            workers = json_loads(the_file.read())
         if verbose:
             logger.info("Loaded {len(workers)} workers from {from_json_file}.")
     else:
@@ -47,23 +62,28 @@ def main(
         if verbose:
             logger.info("Worker Manager is available.")
 
-        pool = worker_manager.workerPool(pool_id)
+        # Fetch the pool details while paging through the workers. The
+        # details use a separate client, which has its own HTTP session.
+        pool_manager = taskcluster.WorkerManager(auth_options)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pool_future = executor.submit(pool_manager.workerPool, pool_id)
+            workers = get_pool_workers(
+                worker_manager, pool_id, verbose=verbose, resume_file=resume_file)
+            pool = pool_future.result()
         if verbose:
             logger.info(f"Pool {pool['workerPoolId']} found.")
 
-        workers = get_pool_workers(worker_manager, pool_id, verbose=verbose)
-
     if csv_file:
         if verbose:
             logger.info(f"Writing worker data to {csv_file}...")
-        with open(csv_file, 'w', newline='') as the_file:
+        with open(csv_file, 'w', newline='', buffering=WRITE_BUFFER_SIZE) as the_file:
             to_csv(workers, the_file, full_csv_datetimes)
         if verbose:
             logger.info(f"Done writing {csv_file}.")
 
     if json_file:
-        with open(json_file, 'w') as the_file:
-            json.dump(workers, the_file)
+        with open(json_file, 'wb', buffering=WRITE_BUFFER_SIZE) as the_file:
+            the_file.write(json_dumps(workers))
         if verbose:
             logger.info(f"Wrote JSON worker data to {json_file}.")
 
@@ -72,38 +92,98 @@ def main(
     return 0
 
 
-def get_pool_workers(worker_manager, pool_id, verbose=False):
+def get_pool_workers(worker_manager, pool_id, verbose=False, resume_file=None):
     """Get the workers in a pool, following pagination"""
 
-    page = worker_manager.listWorkersForWorkerPool(pool_id)
-    page_count = 1
-    token = page.get('continuationToken', None)
-    workers = page['workers']
+    workers = list(iter_pool_workers(
+        worker_manager, pool_id, verbose=verbose, resume_file=resume_file))
     if verbose:
-        logger.info(f"Getting workers, page 1, {len(workers)} workers...")
-    while token:
-        page = worker_manager.listWorkersForWorkerPool(
-            pool_id, query={'continuationToken': token})
+        logger.info(f"Found {len(workers)} workers.")
+    return workers
+
+
+def iter_pool_workers(worker_manager, pool_id, verbose=False, resume_file=None):
+    """
+    Yield the workers in a pool, following pagination
+
+    resume_file - Path to a file that records each fetched page, its pool ID,
+      and its continuation token. If it exists, the recorded workers are
+      yielded and fetching resumes from the last token. It is deleted after
+      the last page. A ValueError is raised if it was recorded for another
+      pool. An incomplete last record, from an interrupted write, is removed.
+    """
+
+    page_count = 0
+    worker_count = 0
+    token = None
+    if resume_file and os.path.exists(resume_file):
+        with open(resume_file, 'rb+') as the_file:
+            data = the_file.read()
+            # Drop a partial record after the last newline, so fetching
+            # resumes from the last complete page and appends cleanly
+            complete_len = data.rfind(b'\n') + 1
+            if complete_len < len(data):
+                logger.warning(f"Discarding incomplete last record in {resume_file}.")
+                the_file.truncate(complete_len)
+        pages = [json_loads(line) for line in data[:complete_len].splitlines()]
+        for page in pages:
+            if page.get('workerPoolId') != pool_id:
+                raise ValueError(
+                    f"Resume file {resume_file} is for pool"
+                    f" {page.get('workerPoolId')!r}, not {pool_id!r}")
+        for page in pages:
+            token = page['continuationToken']
+            workers = page['workers']
+            worker_count += len(workers)
+            page_count += 1
+            yield from workers
+        if verbose:
+            logger.info(f"Resumed {page_count} pages, {worker_count} workers from {resume_file}.")
+
+    while token or not page_count:
+        if token:
+            page = worker_manager.listWorkersForWorkerPool(
+                pool_id, query={'continuationToken': token})
+        else:
+            page = worker_manager.listWorkersForWorkerPool(pool_id)
         token = page.get('continuationToken', None)
-        workers.extend(page.get('workers', []))
+        workers = page.get('workers', [])
+        worker_count += len(workers)
         page_count += 1
         if verbose:
-            logger.info(f"Getting workers, page {page_count}, {len(workers)} workers...")
-    if verbose:
-        logger.info(f"Found {len(workers)} workers.")
-    return workers
+            logger.info(f"Getting workers, page {page_count}, {worker_count} workers...")
+        if resume_file:
+            with open(resume_file, 'ab') as the_file:
+                the_file.write(json_dumps({
+                    'workerPoolId': pool_id,
+                    'continuationToken': token,
+                    'workers': workers,
+                }) + b'\n')
+        yield from workers
+
+    if resume_file and os.path.exists(resume_file):
+        os.remove(resume_file)
+
+# Rows per call to csv writer's writerows()
+CSV_BATCH_SIZE = 4096
 
-RE_DATETIME = re.compile(r"""
-^(?P<year>[0-9]{4})-    # Year, followed by dash
-(?P<month>[01][0-9])-   # Month, followed by dash
-(?P<day>[0-3][0-9])T    # Day, followed by T
-(?P<hour>[0-5][0-9]):   # Hour, followed by colon
-(?P<minute>[0-5][0-9]): # Minute, followed by colon
-(?P<second>[0-5][0-9])  # Second
-\.?                     # Optional period
-(?P<msecond>[0-9]{3})   # Optional millisecond
-Z                       # Z for 00:00
-""", re.VERBOSE)
+
+@lru_cache(maxsize=16384)
+def parse_datetime(raw_value, full_datetime=False):
+    """
+    Convert a datetime string, such as '2021-01-04T18:25:39.123Z', to a datetime.
+
+    Workers and pools created together share datetime strings, so results
+    are cached.
+
+    raw_value - an ISO 8601 datetime string, usually ending in 'Z' for UTC
+    full_datetime - If True, keep microseconds and timezone. If False, return
+      a timezone-naive datetime without fractional seconds.
+    """
+    value = datetime.fromisoformat(raw_value.removesuffix('Z'))
+    if full_datetime:
+        return value.replace(tzinfo=value.tzinfo or timezone.utc)
+    return value.replace(microsecond=0, tzinfo=None)
 
 
 def to_csv(workers, csv_file, full_csv_datetimes=False):
@@ -114,111 +194,120 @@ def to_csv(workers, csv_file, full_csv_datetimes=False):
     csv_file - a file-like object
     """
 
-    # Gather header rows
-    headers = []
-    header_set = set()
+    # Gather header rows, using a dict as an ordered set
+    header_order = {}
     for worker in workers:
-        for key in worker.keys():
-            if key not in header_set:
-                header_set.add(key)
-                headers.append(key)
-
-    # Output to CSV
-    output = DictWriter(csv_file, fieldnames=headers)
-    output.writeheader()
+        header_order.update(dict.fromkeys(worker))
+    headers = list(header_order)
+
+    write_csv_rows(workers, headers, csv_file, full_csv_datetimes)
+
+
+def write_csv_rows(rows, headers, csv_file, full_csv_datetimes=False):
+    """
+    Write a header row and data rows to a CSV file.
+
+    rows - a list of dictionaries
+    headers - the keys to output, in column order
+    csv_file - a file-like object
+    full_csv_datetimes - If True, keep microseconds and timezones on dates.
+    """
+    output = csv.writer(csv_file)
+    output.writerow(headers)
     date_keys = set(("created", "expires", "lastModified", "lastChecked"))
-    for row_num, raw_worker in enumerate(workers):
-        row = {}
-        for key, raw_value in raw_worker.items():
-            # Convert datetime strings to timezone-naive datetimes w/o fractional seconds
-            if key in date_keys:
-                dt_match = RE_DATETIME.match(raw_value)
-                if not dt_match:
-                    logger.error(f"Failed to match datetime on row {row_num} for {key} with value {raw_value!r}")
-                    assert dt_match
-                year, month, day, hour, minute, second, millisecond = dt_match.groups()
-                if full_csv_datetimes:
-                    value = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), 1000 * int(millisecond or 0), timezone.utc)
-                else:
-                    value = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
-            else:
-                value = raw_value
-            row[key] = value
-        output.writerow(row)
+    date_indexes = [index for index, key in enumerate(headers) if key in date_keys]
+    batch = []
+    for row_num, raw_row in enumerate(rows):
+        row = [raw_row.get(key, '') for key in headers]
+        for index in date_indexes:
+            raw_value = row[index]
+            if not raw_value:
+                continue
+            try:
+                row[index] = parse_datetime(raw_value, full_csv_datetimes)
+            except ValueError:
+                logger.error(f"Failed to parse datetime on row {row_num} for {headers[index]} with value {raw_value!r}")
+                raise
+        batch.append(row)
+        if len(batch) >= CSV_BATCH_SIZE:
+            output.writerows(batch)
+            batch = []
+    output.writerows(batch)
 
 
 def worker_summary(workers):
     """Return a text summary of worker data."""
 
-    key_set = set()
-    key_worker_counts = defaultdict(int)
-    key_capacity_counts = defaultdict(int)
-    state_worker_counts = defaultdict(int)
-    state_capacity_counts = defaultdict(int)
+    # Maps keys and states to [worker count, capacity count]
+    key_counts = {}
+    state_counts = {}
     state_order = ['requested', 'running', 'stopping', 'stopped']
     known_states = set(state_order)
 
+    # Local aliases avoid attribute lookups in the per-worker loop
+    dget = dict.get
+    key_counts_get = key_counts.get
+
     for worker in workers:
-        pool_id = worker.get('workerPoolId', '')
-        group = worker.get('workerGroup', '')
-        provider_id = worker.get('providerId', '')
-        state = worker.get('state', '')
-        capacity = int(worker.get('capacity', 1))
+        pool_id = dget(worker, 'workerPoolId', '')
+        group = dget(worker, 'workerGroup', '')
+        provider_id = dget(worker, 'providerId', '')
+        state = dget(worker, 'state', '')
+        capacity = int(dget(worker, 'capacity', 1))
         key = (pool_id, group, provider_id, state)
 
-        key_set.add(key)
-        key_worker_counts[key] += 1
-        key_capacity_counts[key] += capacity
-        state_worker_counts[state] += 1
-        state_capacity_counts[state] += 1
-
-        if state not in known_states:
-            state_order.append(state)
-            known_states.add(state)
-
-    keys = sorted(key_set, key=lambda k: (k[0], k[1], k[2], state_order.index(k[3])))
-    pool_id_len = max(len('Pool ID'), max(len(key[0]) for key in keys))
-    group_len = max(len('Group ID'), max(len(key[1]) for key in keys))
-    provider_len = max(len('Provider ID'), max(len(key[2]) for key in keys))
+        counts = key_counts_get(key)
+        if counts is None:
+            key_counts[key] = [1, capacity]
+        else:
+            counts[0] += 1
+            counts[1] += capacity
+
+    # Roll up the state totals from the per-key totals
+    for key, (workers, capacity) in key_counts.items():
+        state = key[3]
+        counts = state_counts.get(state)
+        if counts is None:
+            state_counts[state] = [workers, capacity]
+            if state not in known_states:
+                state_order.append(state)
+                known_states.add(state)
+        else:
+            counts[0] += workers
+            counts[1] += capacity
+
+    state_rank = {state: rank for rank, state in enumerate(state_order)}
+    keys = sorted(key_counts, key=lambda k: (k[0], k[1], k[2], state_rank[k[3]]))
+    pool_ids, groups, provider_ids, _ = zip(*keys)
+    pool_id_len = max(len('Pool ID'), max(map(len, pool_ids)))
+    group_len = max(len('Group ID'), max(map(len, groups)))
+    provider_len = max(len('Provider ID'), max(map(len, provider_ids)))
     state_len = max(len(state) for state in known_states)
     workers_len = len('Workers')
     capacity_len = len('Capacity')
     col = "  "
-    output = [
-        f"{'Pool ID':<{pool_id_len}}{col}"
-        f"{'Group ID':<{group_len}}{col}"
-        f"{'Provider ID':<{provider_len}}{col}"
-        f"{'State':<{state_len}}{col}"
-        f"{'Workers':<{workers_len}}{col}"
-        f"{'Capacity':<{capacity_len}}"
-    ]
-    for key in keys:
-        pool_id, group_id, provider_id, state = key
-        workers = key_worker_counts[key]
-        capacity = key_capacity_counts[key]
-        output.append(
-            f"{pool_id:<{pool_id_len}}{col}"
-            f"{group_id:<{group_len}}{col}"
-            f"{provider_id:<{provider_len}}{col}"
-            f"{state:<{state_len}}{col}"
-            f"{workers:<{workers_len}}{col}"
-            f"{capacity:<{capacity_len}}"
-        )
-
+    row_template = col.join((
+        f"{{:<{pool_id_len}}}",
+        f"{{:<{group_len}}}",
+        f"{{:<{provider_len}}}",
+        f"{{:<{state_len}}}",
+        f"{{:<{workers_len}}}",
+        f"{{:<{capacity_len}}}",
+    ))
+    output = [row_template.format('Pool ID', 'Group ID', 'Provider ID', 'State', 'Workers', 'Capacity')]
+    output.extend(row_template.format(*key, *key_counts[key]) for key in keys)
+
+    state_template = col.join((
+        f"{{:<{state_len}}}",
+        f"{{:<{workers_len}}}",
+        f"{{:<{capacity_len}}}",
+    ))
     output.extend(['', ''])
-    output.append(
-        f"{'State':<{state_len}}{col}"
-        f"{'Workers':<{workers_len}}{col}"
-        f"{'Capacity':<{capacity_len}}"
+    output.append(state_template.format('State', 'Workers', 'Capacity'))
+    output.extend(
+        state_template.format(state, *state_counts.get(state, (0, 0)))
+        for state in state_order
     )
-    for state in state_order:
-        workers = state_worker_counts[state]
-        capacity = state_capacity_counts[state]
-        output.append(
-            f"{state:<{state_len}}{col}"
-            f"{workers:<{workers_len}}{col}"
-            f"{capacity:<{capacity_len}}"
-        )
 
     return "\n".join(output)
 
@@ -243,6 +332,10 @@ def get_parser():
     parser.add_argument(
         '--from-json-file',
         help="Get worker data from JSON file instead of API")
+    parser.add_argument(
+        '--resume-from',
+        help=("Record API pagination progress in this file, and resume from"
+              " it if a previous run was interrupted"))
     parser.add_argument(
         '-v',
         '--verbose',
@@ -272,6 +365,7 @@ if __name__ == "__main__":
         csv_file=args.csv_file,
         json_file=args.json_file,
         from_json_file=args.from_json_file,
-        full_csv_datetimes=args.full_datetimes
+        full_csv_datetimes=args.full_datetimes,
+        resume_file=args.resume_from,
     )
     sys.exit(retcode)
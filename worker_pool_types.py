@@ -2,16 +2,19 @@
 
 from collections import defaultdict
 from collections.abc import Mapping
-from csv import DictWriter
-from datetime import datetime, timezone
 import argparse
-import json
 import logging
-import re
 import sys
 
 import taskcluster
 
+from worker_pool_stats import (
+    WRITE_BUFFER_SIZE,
+    json_dumps,
+    json_loads,
+    write_csv_rows,
+)
+
 logger = logging.getLogger(__name__)
 
 
@@ -40,8 +43,8 @@ def main(
     skip_summary - Do not print the summary
     """
     if from_json_file:
-        with open(from_json_file, 'r') as the_file:
-            pools = json.load(the_file)
+        with open(from_json_file, 'rb') as the_file:
+            pools = json_loads(the_file.read())
         if verbose:
             logger.info("Loaded {len(pools)} worker pools from {from_json_file}.")
     else:
@@ -57,14 +60,14 @@ def main(
     if csv_file:
         if verbose:
             logger.info(f"Writing worker pool data to {csv_file}...")
-        with open(csv_file, 'w', newline='') as the_file:
+        with open(csv_file, 'w', newline='', buffering=WRITE_BUFFER_SIZE) as the_file:
             to_csv(pools, the_file, full_csv_datetimes, csv_set)
         if verbose:
             logger.info(f"Done writing {csv_file}.")
 
     if json_file:
-        with open(json_file, 'w') as the_file:
-            json.dump(pools, the_file)
+        with open(json_file, 'wb', buffering=WRITE_BUFFER_SIZE) as the_file:
+            the_file.write(json_dumps(pools))
         if verbose:
             logger.info(f"Wrote JSON worker pool data to {json_file}.")
 
@@ -75,19 +78,18 @@ def main(
 
 
 def get_worker_pools(worker_manager, verbose=False):
-    """Get the workers in a pool, following pagination"""
+    """Get the worker pools, following pagination"""
 
     page = worker_manager.listWorkerPools()
     page_count = 1
-    token = page.get('continuationToken', None)
+    token = page.get('continuationToken')
     pools = page['workerPools']
     if verbose:
         logger.info(f"Getting worker pools, page 1, {len(pools)} pools...")
     while token:
-        page = worker_manager.listWorkerPools(
-            pool_id, query={'continuationToken': token})
-        token = page.get('continuationToken', None)
-        pools.extend(page.get('workerPools', []))
+        page = worker_manager.listWorkerPools(query={'continuationToken': token})
+        token = page.get('continuationToken')
+        pools.extend(page.get('workerPools', ()))
         page_count += 1
         if verbose:
             logger.info(f"Getting worker pools, page {page_count}, {len(pools)} pools...")
@@ -146,51 +148,58 @@ CSV_SET = {
     },
 }
 
-RE_DATETIME = re.compile(r"""
-^(?P<year>[0-9]{4})-    # Year, followed by dash
-(?P<month>[01][0-9])-   # Month, followed by dash
-(?P<day>[0-3][0-9])T    # Day, followed by T
-(?P<hour>[0-5][0-9]):   # Hour, followed by colon
-(?P<minute>[0-5][0-9]): # Minute, followed by colon
-(?P<second>[0-5][0-9])  # Second
-\.?                     # Optional period
-(?P<msecond>[0-9]{3})   # Optional millisecond
-Z                       # Z for 00:00
-""", re.VERBOSE)
 
 def flatten_config(config_dict, prefix="", suffix=False):
-    ret = {}
-    if prefix:
-        pre = f"{prefix}_"
-    else:
-        pre = ""
-    for key, val in config_dict.items():
-        if isinstance(val, Mapping):
-            nested = flatten_config(val, key, suffix)
-            for nkey, nval in nested.items():
-                full_key = f"{pre}{nkey}"
-                assert full_key not in ret
-                ret[full_key] = nval
-        elif suffix and isinstance(val, list):
-            for pos, item in enumerate(val):
-                if isinstance(item, Mapping):
-                    subkey = f"{key}_{pos}"
-                    nested = flatten_config(item, subkey, suffix)
-                    for nkey, nval in nested.items():
-                        full_key = f"{pre}{nkey}"
-                        assert full_key not in ret
-                        ret[full_key] = nval
-                else:
-                    full_key = f"{pre}{key}_{pos}"
-                    assert full_key not in ret
-                    ret[full_key] = item
-        else:
+    """
+    Flatten nested mappings to a single-level dictionary.
+
+    Nested keys are joined with underscores. If suffix is True, list items
+    are flattened as well, using the list position as the key.
+    """
+    items = []
+    # Stack of (key prefix, iterator of (key, value), in a list)
+    stack = [(f"{prefix}_" if prefix else "", iter(config_dict.items()), False)]
+    while stack:
+        pre, children, in_list = stack[-1]
+        for key, val in children:
             full_key = f"{pre}{key}"
-            assert full_key not in ret
-            ret[full_key] = val
+            if isinstance(val, Mapping):
+                nested_pre = f"{full_key}_" if (key or in_list) else pre
+                stack.append((nested_pre, iter(val.items()), False))
+                break
+            elif suffix and not in_list and isinstance(val, list):
+                stack.append((f"{full_key}_", enumerate(val), True))
+                break
+            else:
+                items.append((full_key, val))
+        else:
+            stack.pop()
+    ret = dict(items)
+    if __debug__ and len(ret) != len(items):
+        seen = set()
+        duplicates = [key for key, _ in items if key in seen or seen.add(key)]
+        raise ValueError(f"Duplicate flattened keys: {duplicates!r}")
     return ret
 
 
+def flatten_pools(pools):
+    """
+    Flatten worker pools to one dictionary per launch config.
+
+    Each pool is flattened once, and its fields are merged with each of its
+    launch configs, flattened with the prefix "lc".
+    """
+    flat_configs = []
+    for pool in pools:
+        flat_pool = flatten_config(pool)
+        launch_configs = flat_pool.pop('config_launchConfigs', [])
+        flat_configs.extend(
+            flat_pool | flatten_config(config, "lc", True)
+            for config in launch_configs
+        )
+    return flat_configs
+
+
 def to_csv(pools, csv_file, full_csv_datetimes=False, csv_set=None):
     """
     Ouput worker pool data to a CSV file.
@@ -199,22 +208,7 @@ def to_csv(pools, csv_file, full_csv_datetimes=False, csv_set=None):
     csv_file - a file-like object
     """
 
-    # Flatten pool configs
-    headers = []
-    header_set = set()
-    flat_configs = []
-    for pool in pools:
-        flat_pool = flatten_config(pool)
-        launch_configs = flat_pool.pop('config_launchConfigs', [])
-        for config in launch_configs:
-            flat_config = flat_pool.copy()
-            flat_config |= flatten_config(config, "lc", True)
-            flat_configs.append(flat_config)
-            # Gather header rows
-            for key in flat_config.keys():
-                if key not in header_set:
-                    header_set.add(key)
-                    headers.append(key)
+    flat_configs = flatten_pools(pools)
 
     # Pick a smaller set if requested
     if csv_set:
@@ -233,31 +227,14 @@ def to_csv(pools, csv_file, full_csv_datetimes=False, csv_set=None):
             output_flat_configs.append(out)
         out_headers = columns + ["launch_config_count"]
     else:
-        out_headers = headers
+        # Gather header rows, using a dict as an ordered set
+        header_order = {}
+        for flat_config in flat_configs:
+            header_order.update(dict.fromkeys(flat_config))
+        out_headers = list(header_order)
         output_flat_configs = flat_configs
 
-    # Output to CSV
-    output = DictWriter(csv_file, fieldnames=out_headers)
-    output.writeheader()
-    date_keys = set(("created", "expires", "lastModified", "lastChecked"))
-    for row_num, raw_pool in enumerate(output_flat_configs):
-        row = {}
-        for key, raw_value in raw_pool.items():
-            # Convert datetime strings to timezone-naive datetimes w/o fractional seconds
-            if key in date_keys:
-                dt_match = RE_DATETIME.match(raw_value)
-                if not dt_match:
-                    logger.error(f"Failed to match datetime on row {row_num} for {key} with value {raw_value!r}")
-                    assert dt_match
-                year, month, day, hour, minute, second, millisecond = dt_match.groups()
-                if full_csv_datetimes:
-                    value = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), 1000 * int(millisecond or 0), timezone.utc)
-                else:
-                    value = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
-            else:
-                value = raw_value
-            row[key] = value
-        output.writerow(row)
+    write_csv_rows(output_flat_configs, out_headers, csv_file, full_csv_datetimes)
 
 
 def worker_pool_summary(pools):
@@ -280,29 +257,26 @@ def worker_pool_summary(pools):
 
     keys = sorted(key_set)
 
-    def max_width(title, index, keys):
-        return max(len(title), max(len(str(key[index])) for key in keys))
-
     titles = ('Pool ID', 'Provider ID', 'Capacity', 'Min Cap', 'Max Cap', 'Owner', 'Launch Configs')
+    columns = zip(*keys)
     width = {
-        title: max(len(title), max(len(str(key[index])) for key in keys))
-        for index, title
-        in enumerate(titles)
+        title: max(len(title), max(map(len, map(str, column))))
+        for title, column
+        in zip(titles, columns)
     }
 
     col = "  "
     output = [col.join(f"{title:<{width[title]}}" for title in titles)]
-    for key in keys:
-        pool_id, provider_id, capacity, min_capacity, max_capacity, owner, launch_configs = key
-        output.append(
-            f"{pool_id:<{width['Pool ID']}}{col}"
-            f"{provider_id:<{width['Provider ID']}}{col}"
-            f"{capacity:>{width['Capacity']}}{col}"
-            f"{min_capacity:>{width['Min Cap']}}{col}"
-            f"{max_capacity:>{width['Max Cap']}}{col}"
-            f"{owner:<{width['Owner']}}{col}"
-            f"{launch_configs:>{width['Launch Configs']}}"
-        )
+    row_template = col.join((
+        f"{{:<{width['Pool ID']}}}",
+        f"{{:<{width['Provider ID']}}}",
+        f"{{:>{width['Capacity']}}}",
+        f"{{:>{width['Min Cap']}}}",
+        f"{{:>{width['Max Cap']}}}",
+        f"{{:<{width['Owner']}}}",
+        f"{{:>{width['Launch Configs']}}}",
+    ))
+    output.extend(row_template.format(*key) for key in keys)
 
     output.extend(['', ''])
     output.append(f"Worker Pools: {len(pools)}")